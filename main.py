@@ -1,23 +1,20 @@
+import asyncio
 import logging
 import os
 import time
-import xml.etree.ElementTree as ET
-import re
-import requests
-import urllib3
+import hashlib
 import html
+import io
+import re
+import ahocorasick
+import aiohttp
+from collections import OrderedDict
 from dotenv import load_dotenv
-from selenium import webdriver
-from bs4 import BeautifulSoup
-from selenium.webdriver.chrome.options import Options
-from selenium.common.exceptions import WebDriverException
+from lxml import etree
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Suppress SSL warnings
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
 # Configure logging
 logging.basicConfig(filename="rss_watcher.log", level=logging.INFO,
                     format="%(asctime)s - %(levelname)s - %(message)s")
@@ -27,7 +24,7 @@ PUSHOVER_TOKEN = os.getenv("PUSHOVER_TOKEN")
 PUSHOVER_USER_KEY = os.getenv("PUSHOVER_USER_KEY")
 
 # Read the wait time between feed checks from the environment variable
-# If not provided, default to 60 seconds
+# If not provided, default to 120 seconds
 WAIT_TIME = int(os.getenv("WAIT_TIME", 120))
 
 headers = {
@@ -36,121 +33,259 @@ headers = {
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36'
 }
 
-seen_posts = set()
+FEED_URL = "https://uhrforum.de/forums/-/index.rss"
+FEED_TIMEOUT = aiohttp.ClientTimeout(total=15)
+
+PUSHOVER_URL = "https://api.pushover.net/1/messages.json"
+PUSHOVER_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+# Stop sending notifications for NOTIFY_COOLDOWN seconds after NOTIFY_FAILURE_THRESHOLD failures in a row
+NOTIFY_FAILURE_THRESHOLD = 5
+NOTIFY_COOLDOWN = 300
+
+# Ampersands that don't start an entity or character reference, lxml would silently drop them.
+# CDATA sections are matched as well so the ampersands inside them can be left alone.
+BARE_AMPERSAND_RE = re.compile(rb'<!\[CDATA\[.*?\]\]>|&(?!#?\w+;)', re.DOTALL)
+
+# Parser errors after which libxml2 stops reading, because the feed was cut short or hit broken markup.
+# Everything else (undefined entities, invalid characters, ...) is recovered from without losing items.
+PARSE_STOPPED_ERRORS = {
+    etree.ErrorTypes.ERR_DOCUMENT_EMPTY,
+    etree.ErrorTypes.ERR_TAG_NOT_FINISHED,
+    etree.ErrorTypes.ERR_GT_REQUIRED,
+    etree.ErrorTypes.ERR_NAME_REQUIRED,
+}
+
+# Check whether an item belongs to the "Angebote" category
+IS_ANGEBOT_XPATH = etree.XPath(
+    "boolean(category[@domain='https://uhrforum.de/forums/angebote.11/'"
+    " and normalize-space(text())='Angebote'])"
+)
+
+# 64-bit hashes of the guids of posts already seen, oldest first, capped at SEEN_POSTS_LIMIT entries
+SEEN_POSTS_LIMIT = 5000
+seen_posts = OrderedDict()
 
 first_run = True
 is_error = False
 
-def send_initial_notification():
-    response = requests.post(
-        "https://api.pushover.net/1/messages.json",
+# Validators of the last fetched feed, sent back so unchanged feeds answer with 304
+_etag = None
+_last_mod = None
+
+# Digest of the last fetched feed body, for origins that ignore the validators
+_last_hash = None
+
+# Consecutive failed notifications and the monotonic time until which sending is suspended
+_fail_count = 0
+_suppress_until = 0
+
+# Raw FILTER_KEYWORDS value and the keyword automaton built from it
+_cached_filter = (None, None)
+
+async def _push(session, title, message):
+    async with session.post(
+        PUSHOVER_URL,
         data={
             "token": PUSHOVER_TOKEN,
             "user": PUSHOVER_USER_KEY,
-            "message": "Watcher is active and monitoring the RSS feed.",
-            "title": "Uhrforum Watcher"
-        }
-    )
+            "message": message,
+            "title": title
+        },
+        timeout=PUSHOVER_TIMEOUT
+    ) as response:
+        return response.status
+
+async def send_initial_notification(session):
+    await _push(session, "Uhrforum Watcher", "Watcher is active and monitoring the RSS feed.")
     logging.info("~ Uhrforum Watcher started ~")
 
-def send_error_notification(error_message):
+async def send_error_notification(session, error_message):
     message = f"Error occured: {error_message}"
-    response = requests.post(
-        "https://api.pushover.net/1/messages.json",
-        data={
-            "token": PUSHOVER_TOKEN,
-            "user": PUSHOVER_USER_KEY,
-            "message": message,
-            "title": "Uhrforum Watcher"
-        }
-    )
+    await _push(session, "Uhrforum Watcher", message)
     logging.info("Error notification sent")
 
-def send_notification(title, link):
-    message = f"New Post: {title}\nLink: {link}"
-    response = requests.post(
-        "https://api.pushover.net/1/messages.json",
-        data={
-            "token": PUSHOVER_TOKEN,
-            "user": PUSHOVER_USER_KEY,
-            "message": message,
-            "title": "New UhrForum Post"
-        }
-    )
-    if response.status_code == 200:
-        logging.info(f"Notification sent for post: {title}")
-    else:
-        logging.info(f"Failed to send notification: {response.status_code}")
+async def send_notification(session, limiter, title, link):
+    """
+    Send a new post notification, returns False if it was held back because notifications are suspended
+    """
+    global _fail_count
+    global _suppress_until
+
+    # Limit the sends in flight so the breaker can trip in the middle of a burst
+    async with limiter:
+        # Don't keep hammering Pushover while it is failing
+        if time.monotonic() < _suppress_until:
+            logging.info(f"Notifications suspended, holding back post: {title}")
+            return False
+
+        message = f"New Post: {title}\nLink: {link}"
+        # Notifications are sent concurrently, so a failing one must not take the others down
+        try:
+            status = await _push(session, "New UhrForum Post", message)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Failed to send notification: {e}")
+            status = None
+        if status == 200:
+            _fail_count = 0
+            logging.info(f"Notification sent for post: {title}")
+            return True
+
+        if status is not None:
+            logging.info(f"Failed to send notification: {status}")
+        _fail_count += 1
+        if _fail_count >= NOTIFY_FAILURE_THRESHOLD:
+            _fail_count = 0
+            _suppress_until = time.monotonic() + NOTIFY_COOLDOWN
+            logging.error(f"{NOTIFY_FAILURE_THRESHOLD} notifications failed in a row, suspending for {NOTIFY_COOLDOWN} seconds")
+        return True
+
+
+def guid_key(guid):
+    # The keys never outlive the process, so the salted built-in hash is stable enough
+    return hash(guid) & 0xFFFFFFFFFFFFFFFF
+
+
+def remember_posts(keys):
+    seen_posts.update(dict.fromkeys(keys))
+    # Forget the oldest posts once the limit is reached
+    while len(seen_posts) > SEEN_POSTS_LIMIT:
+        seen_posts.popitem(last=False)
+
+
+def escape_bare_ampersands(rss_bytes):
+    return BARE_AMPERSAND_RE.sub(lambda match: match.group() if match.group() != b'&' else b'&amp;', rss_bytes)
 
 
-def check_feed():
+def iter_angebote_items(rss_bytes):
+    """
+    Stream the <item> elements of the "Angebote" category, freeing each item once it has been processed
+    """
+    # Escape bare ampersands so they survive parsing, recover from any other broken markup
+    rss_bytes = escape_bare_ampersands(rss_bytes)
+    context = etree.iterparse(io.BytesIO(rss_bytes), events=("end",), tag="item",
+                              recover=True, huge_tree=False, resolve_entities=False)
+    for _, item in context:
+        if IS_ANGEBOT_XPATH(item):
+            yield item
+        # Drop the processed item and everything parsed before it
+        item.clear()
+        while item.getprevious() is not None:
+            del item.getparent()[0]
+
+    # Recovering never raises, so a body that is no feed at all or was cut short has to be caught here
+    for error in context.error_log:
+        if error.type in PARSE_STOPPED_ERRORS:
+            raise etree.XMLSyntaxError(error.message, error.type, error.line, error.column)
+        logging.warning(f"Recovered from XML error at line {error.line}, column {error.column}: {error.message}")
+    if context.root is None or context.root.tag != "rss":
+        raise etree.XMLSyntaxError("No <rss> root element found", None, 0, 0)
+
+
+async def check_feed(session):
     global first_run
     global is_error
+    global _etag
+    global _last_mod
+    global _last_hash
+
+    filter_automaton = update_filter_keywords()
+
+    # Only download the feed if it changed since the last check
+    cond = {}
+    if _etag:
+        cond["If-None-Match"] = _etag
+    if _last_mod:
+        cond["If-Modified-Since"] = _last_mod
 
-    filter_keywords = update_filter_keywords()
     # Fetch the RSS feed while bypassing SSL verification and using custom headers
-    options = Options()
-    # Run Chrome in headless mode so it doesn't steal focus
-    # Use the modern headless mode where available
-    options.add_argument("--headless=new")
-    options.add_argument("--disable-gpu")
-    options.add_argument("--no-sandbox")
-    options.add_argument("--disable-dev-shm-usage")
-    options.add_argument("--window-size=1920,1080")
-    # Provide the same user-agent as used for requests
-    options.add_argument(f"user-agent={headers['User-Agent']}")
-    driver = webdriver.Chrome(options=options)
     try:
-        url = "https://uhrforum.de/forums/-/index.rss"
-        driver.get(url)
-    except WebDriverException as e:
-        logging.error(f"WebDriver error occurred: {e}")
-        driver.quit()
+        async with session.get(FEED_URL, headers={**headers, **cond}, ssl=False,
+                               timeout=FEED_TIMEOUT) as response:
+            status = response.status
+            response_headers = response.headers
+            rss_bytes = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Request error occurred: {e}")
+        return
+
+    if status == 304:
+        logging.info("Feed not modified since last check.")
         return
 
-    rss_content = driver.page_source
-    driver.quit()
-    
     # Check if the content is not empty
-    if not rss_content:
+    if not rss_bytes:
         logging.error("No content found in the response.")
         return
-    
-    if "403 Forbidden" in rss_content or "not authorized" in rss_content:
+
+    if status == 403 or b"403 Forbidden" in rss_bytes or b"not authorized" in rss_bytes:
         logging.error("Access denied or forbidden error detected!")
         return
-    
-    soup = BeautifulSoup(rss_content, "html.parser")
-    pre_tag = soup.find("pre")
 
-    if not pre_tag:
-        if not is_error:
-            is_error = True
-            send_error_notification("No <pre> tag found — RSS feed not formatted as expected")
+    # Rate limits and server errors come back as HTML pages, don't mistake them for the feed
+    if status != 200:
+        logging.error(f"Unexpected response status: {status}")
+        return
+
+    _etag = response_headers.get("ETag")
+    _last_mod = response_headers.get("Last-Modified")
 
-        logging.error("No <pre> tag found — RSS feed not formatted as expected")
+    # Skip parsing entirely if the feed is byte-identical to the last one
+    rss_hash = hashlib.blake2b(rss_bytes, digest_size=16).digest()
+    if rss_hash == _last_hash:
+        logging.info("Feed unchanged since last check.")
         return
+    _last_hash = rss_hash
 
-    is_error = False
-    rss_escaped = pre_tag.text
+    if not rss_bytes.lstrip().startswith((b"<?xml", b"<rss")):
+        # The feed is wrapped in an HTML page, slice the escaped XML out of the <pre> tag
+        pre_start = rss_bytes.find(b"<pre")
+        pre_end = rss_bytes.rfind(b"</pre>")
+        content_start = rss_bytes.find(b">", pre_start) + 1
 
-    # Unescape HTML entities
-    rss_unescaped = html.unescape(rss_escaped)
-    safe_rss = fix_common_xml_problems(rss_unescaped)
-    # Parse the XML content
-    try:
-        root = ET.fromstring(safe_rss)
-    except ET.ParseError as e:
-        match = re.search(r"line (\d+), column (\d+)", str(e))
-        if match:
-            line_num = int(match.group(1))
-            col_num = int(match.group(2))
+        if pre_start == -1 or content_start == 0 or pre_end < content_start:
+            if not is_error:
+                is_error = True
+                await send_error_notification(session, "No <pre> tag found — RSS feed not formatted as expected")
 
+            logging.error("No <pre> tag found — RSS feed not formatted as expected")
+            return
+
+        # Unescape the HTML entities of the <pre> content once, bare ampersands are escaped again when parsing
+        rss_bytes = html.unescape(rss_bytes[content_start:pre_end].decode("utf-8", errors="replace")).encode("utf-8")
+
+    # Parse the XML content item by item
+    new_keys = []
+    new_posts = []
+    try:
+        for item in iter_angebote_items(rss_bytes):
+            title = item.findtext('title', '')
+            link = item.findtext('link', '')
+            # Fall back to the link so posts without a guid don't all share one key
+            guid = item.findtext('guid') or link
+            if not guid:
+                logging.warning(f"Skipping post without guid or link: {title}")
+                continue
+            key = guid_key(guid)
+            # If it's the first run, just mark posts as seen without sending notifications
+            if first_run:
+                new_keys.append(key)
+            # Send notification for new posts only after the first run
+            elif key not in seen_posts:
+                # Check if filtering is required
+                title_lower = title.lower()
+                if filter_automaton is None or next(filter_automaton.iter(title_lower), None) is not None:
+                    new_posts.append((title, link, key))
+                else:
+                    new_keys.append(key)
+    except etree.XMLSyntaxError as e:
+        line_num, col_num = e.position
+        if line_num:
             # Get the specific line from the XML
-            lines = safe_rss.splitlines()
+            lines = rss_bytes.decode("utf-8", errors="replace").splitlines()
 
             logging.error(f"XML Parse Error at line {line_num}, column {col_num}:")
-            if 0 < line_num <= len(lines):
+            if line_num <= len(lines):
                 error_line = lines[line_num - 1]
                 logging.error(f"{line_num:4d}: {error_line}")
                 # Optionally print a marker to show column
@@ -158,36 +293,28 @@ def check_feed():
             else:
                 logging.error("Line number out of range.")
         else:
-            logging.error(f"XML Parse Error: {e}")
+            # No position to point at, e.g. the body parsed but wasn't an RSS feed
+            logging.error(f"XML Parse Error: {e.msg}")
+
+        if not is_error:
+            is_error = True
+            await send_error_notification(session, f"RSS feed could not be parsed: {e.msg}")
         return
+    finally:
+        # Notify about and remember every new post found, even if parsing failed further down the feed
+        limiter = asyncio.Semaphore(NOTIFY_FAILURE_THRESHOLD)
+        handled = await asyncio.gather(*(send_notification(session, limiter, title, link)
+                                         for title, link, _ in new_posts))
+        new_keys.extend(key for (_, _, key), was_handled in zip(new_posts, handled) if was_handled)
+        remember_posts(new_keys)
+
+        # Posts held back while notifications are suspended stay unseen, make sure the next check parses the feed again
+        if not all(handled):
+            _etag = None
+            _last_mod = None
+            _last_hash = None
 
-    channel = root.find('channel')
-    # Collect only items in the "Angebote" category
-    angebote_items = []
-
-    for item in channel.findall('item'):
-        categories = item.findall('category')
-        for cat in categories:
-            domain = cat.attrib.get('domain')
-            text = cat.text.strip() if cat.text else ""
-
-            if domain == "https://uhrforum.de/forums/angebote.11/" and text == "Angebote":
-                angebote_items.append(item)
-                break  # Match found, no need to check other categories
-
-    for item in angebote_items:
-        title = item.find('title').text
-        link = item.find('link').text
-        guid = item.find('guid').text
-        # If it's the first run, just mark posts as seen without sending notifications
-        if first_run:
-            seen_posts.add(guid)
-        # Send notification for new posts only after the first run
-        elif guid not in seen_posts:
-            # Check if filtering is required
-            if not filter_keywords or any(keyword in title.lower() for keyword in filter_keywords):
-                send_notification(title, link)
-            seen_posts.add(guid)
+    is_error = False
 
     # After the first run, set first_run to False
     if first_run:
@@ -195,60 +322,46 @@ def check_feed():
 
 
 # Main loop to run the feed check every minute
-def monitor_feed():
-    while True:
-        try:
-            logging.info("Checking for new posts...")
-            WAIT_TIME = int(os.getenv("WAIT_TIME", 120))
-            check_feed()
-        except Exception as e:
-            logging.error(f"Error during feed check: {e}", exc_info=True)
-        time.sleep(WAIT_TIME)
-
-def escape_xml_text_nodes(elem):
-    """
-    Recursively escape <, >, & in text and tail content of an ElementTree element
-    """
-    if elem.text:
-        elem.text = html.escape(elem.text)
-    for child in elem:
-        escape_xml_text_nodes(child)
-        if child.tail:
-            child.tail = html.escape(child.tail)
-
-
-def fix_common_xml_problems(xml_text: str) -> str:
-    try:
-        # Try to parse it first — if valid, no changes needed
-        root = ET.fromstring(xml_text)
-        return xml_text  # already fine
-    except ET.ParseError:
-        pass  # we'll fix it below
-
-    # Try escaping ampersands not in proper entities
-    cleaned = re.sub(r'&(?!#?\w+;)', '&amp;', xml_text)
-
-    # Try parsing again
-    try:
-        root = ET.fromstring(cleaned)
-        escape_xml_text_nodes(root)
-        return ET.tostring(root, encoding='unicode')
-    except ET.ParseError as e:
-        # Fallback: just return the ampersand-cleaned one
-        return cleaned
+async def monitor_feed():
+    # One connection pool shared by the feed checks and the Pushover notifications
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=10)) as session:
+        await send_initial_notification(session)
+        while True:
+            try:
+                logging.info("Checking for new posts...")
+                await check_feed(session)
+            except Exception as e:
+                logging.error(f"Error during feed check: {e}", exc_info=True)
+            await asyncio.sleep(WAIT_TIME)
 
 def update_filter_keywords():
+    global _cached_filter
+
     # Read filter keywords from the environment variable
     FILTER_KEYWORDS = os.getenv("FILTER_KEYWORDS")
 
+    # Only parse the keywords again if the environment variable changed
+    if FILTER_KEYWORDS == _cached_filter[0]:
+        return _cached_filter[1]
+
     # If FILTER_KEYWORDS is not None, split it into a list, else keep it as an empty list
     if FILTER_KEYWORDS:
         logging.info("Current filter: " + FILTER_KEYWORDS)
         filter_keywords = [keyword.strip().lower() for keyword in FILTER_KEYWORDS.split(',')]
+        filter_keywords = [keyword for keyword in filter_keywords if keyword]
     else:
         filter_keywords = []
-    return filter_keywords
+
+    # Match all keywords in a single pass over the title, no automaton means no filtering
+    filter_automaton = None
+    if filter_keywords:
+        filter_automaton = ahocorasick.Automaton()
+        for keyword in filter_keywords:
+            filter_automaton.add_word(keyword, keyword)
+        filter_automaton.make_automaton()
+
+    _cached_filter = (FILTER_KEYWORDS, filter_automaton)
+    return filter_automaton
 
 if __name__ == "__main__":
-    send_initial_notification()
-    monitor_feed()
+    asyncio.run(monitor_feed())